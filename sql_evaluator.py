@@ -1,21 +1,56 @@
 import itertools
 import json
-from collections import defaultdict
+import math
+import os
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import pairwise, starmap
+from operator import itemgetter, le
 from table import Table
 from table_filter import TableFilter
 
+"""
+Cross products with at least this many combinations and leftover
+clauses to check are split across worker processes.
+"""
+PARALLEL_THRESHOLD = 1000000
+
+"""
+Roughly how many combinations each worker partition covers, which
+bounds the size of each partition's result.
+"""
+PARTITION_SIZE = 100000
+
+"""
+Equi-joins on int columns use a sort-merge join instead of a hash join
+when the two inputs have at least MERGE_JOIN_THRESHOLD rows between
+them, the larger one is at most MERGE_JOIN_MAX_RATIO times the size of
+the smaller one, and the larger one is already sorted on its keys.
+Below that, or with more skewed sizes, the hash join is faster.
+"""
+MERGE_JOIN_THRESHOLD = 1000000
+MERGE_JOIN_MAX_RATIO = 2
+
+
+def build_column_index(tables):
+    """
+    Map each column name to the tables that contain it, so that
+    unqualified column references can be resolved with a lookup.
+    """
+    col_index = defaultdict(list)
+    for table in tables:
+        for header in table.headers:
+            col_index[header].append(table)
 
-def get_table_for_field(field_name, tables):
+    return col_index
+
+def get_table_for_field(field_name, col_index):
     """
     Determine the table for a given column name without
     a specificed table. When inferring the table, it's
     important that there be only one possibility. 
     """
-    tables_with_field = [
-            t
-            for t in tables
-            if field_name in t.headers
-    ]
+    tables_with_field = col_index[field_name]
 
     if len(tables_with_field) > 1:
         raise Exception('Column "{fieldname}" is ambiguous,'
@@ -25,7 +60,7 @@ def get_table_for_field(field_name, tables):
 
     return tables_with_field[0]
 
-def validate_and_coalesce_select(query, tables):
+def validate_and_coalesce_select(query, tables_by_name, col_index):
     """
     1. Check to see that all fieldnames referenced in the select
     have only one source table. 
@@ -44,21 +79,20 @@ def validate_and_coalesce_select(query, tables):
     for field in query['select']:
 
         if not field['column']['table']:
-            field['column']['table'] = get_table_for_field(field['column']['name'], tables).name
+            field['column']['table'] = get_table_for_field(field['column']['name'], col_index).name
 
         if field['column']['table']:
             table_name = field['column']['table']
-            source_tables = {x['as']: x['source'] for x in query['from']}
 
-            if table_name not in source_tables:
+            if table_name not in tables_by_name:
                 raise Exception('Table "{table}" referenced, but not in FROM clause'\
                                 .format(table=field['column']['table']))
 
-            table = (t for t in tables if t.name == table_name).__next__()
+            table = tables_by_name[table_name]
             if field['column']['name'] not in table.headers:
-                raise Exception('Field "{field}" referenced, but not in ' + \
-                                'source table {table}'.format(field=field['column']['name'],
-                                                             table=source_table_name))
+                raise Exception(('Field "{field}" referenced, but not in ' + \
+                                'source table {table}').format(field=field['column']['name'],
+                                                               table=table_name))
             query_headers.append([
                 field['as'],
                 table.headers[field['column']['name']]])
@@ -66,7 +100,7 @@ def validate_and_coalesce_select(query, tables):
     return query_headers
 
 
-def parse_where_clause(query, tables):
+def parse_where_clause(query, tables_by_name, col_index):
     """
     1. Check to see that all fieldnames referenced in the where 
     have only one source table. 
@@ -93,11 +127,14 @@ def parse_where_clause(query, tables):
             if 'column' in expression:
                 field_name = expression['column']['name']
                 if expression['column']['table']:
-                    table = [t for t in tables
-                             if t.name == expression['column']['table']][0]
+                    if expression['column']['table'] not in tables_by_name:
+                        raise Exception('Table "{table}" referenced, but not in FROM clause'\
+                                        .format(table=expression['column']['table']))
+
+                    table = tables_by_name[expression['column']['table']]
 
                 else:
-                    table = get_table_for_field(field_name, tables)
+                    table = get_table_for_field(field_name, col_index)
                     expression['column']['table'] = table.name
 
                 """
@@ -131,15 +168,323 @@ def parse_where_clause(query, tables):
 
     return early_clauses, late_clauses
 
-def evaluate_select(row, query):
-    """Grab the fields from the select query and properly order the results."""
-    filtered_row = []
+def referenced_columns(query):
+    """
+    Collect the columns that are needed to evaluate the query,
+    namespaced by table name. This has to run after the SELECT and
+    WHERE clauses have had their tables inferred.
+    """
+    field_names = defaultdict(set)
 
     for field in query['select']:
-        field_name = '.'.join([field['column']['table'], field['column']['name']])
-        filtered_row.append(row[field_name])
+        field_names[field['column']['table']].add(field['column']['name'])
+
+    for condition in query['where']:
+        for side in ('left', 'right'):
+            if 'column' in condition[side]:
+                column = condition[side]['column']
+                field_names[column['table']].add(column['name'])
+
+    return field_names
+
+def push_down_equalities(query, early_clauses):
+    """
+    Columns and literals connected by equality conditions form
+    equivalence classes. Every column in a class that contains a
+    literal can be filtered by that literal before the join, so
+    (A.x = B.x AND A.x = 5) also adds B.x = 5 to the early clauses.
+    """
+    parent = {}
+
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            node = parent[node]
+
+        return node
+
+    def to_node(expression):
+        if 'column' in expression:
+            return ('column', expression['column']['table'], expression['column']['name'])
+
+        return ('literal', expression['literal'])
+
+    for condition in query['where']:
+        if condition['op'] == '=':
+            parent[find(to_node(condition['left']))] = find(to_node(condition['right']))
+
+    classes = defaultdict(list)
+    for node in parent:
+        classes[find(node)].append(node)
+
+    """
+    The column = literal equalities that are already early clauses, as
+    (table, column, literal) whichever side the literal was written on.
+    """
+    existing = set()
+    for conditions in early_clauses.values():
+        for condition in conditions:
+            if condition['op'] != '=':
+                continue
+
+            for column, literal in ((condition['left'], condition['right']),
+                                    (condition['right'], condition['left'])):
+                if 'column' in column and 'literal' in literal:
+                    existing.add((column['column']['table'], column['column']['name'], literal['literal']))
+
+    for members in classes.values():
+        literals = [node[1] for node in members if node[0] == 'literal']
+        columns = [node[1:] for node in members if node[0] == 'column']
+
+        for literal in literals:
+            for table_name, field_name in columns:
+                if (table_name, field_name, literal) in existing:
+                    continue
+
+                existing.add((table_name, field_name, literal))
+                early_clauses[table_name].append({
+                    'op': '=',
+                    'left': {'column': {'table': table_name, 'name': field_name}},
+                    'right': {'literal': literal},
+                })
+
+def split_join_clauses(late_clauses):
+    """
+    Separate the equi-join conditions (column = column) from the
+    rest of the late clauses. Equi-joins can be evaluated with a
+    hash join instead of filtering the full cross product.
+    """
+    equi_joins = []
+    residual = []
+
+    for condition in late_clauses:
+        if condition['op'] == '=' and \
+                'column' in condition['left'] and 'column' in condition['right']:
+            equi_joins.append(condition)
+        else:
+            residual.append(condition)
+
+    return equi_joins, residual
+
+def hash_join(left, right, left_keys, right_keys):
+    """
+    Join two lists of rows where the values of left_keys equal the
+    values of right_keys. The index is built on the smaller side and
+    the larger side is streamed through it. Joined rows are always
+    the left row followed by the right row.
+    """
+    left_key, right_key = itemgetter(*left_keys), itemgetter(*right_keys)
+
+    if len(left) <= len(right):
+        index = defaultdict(list)
+        for row in left:
+            index[left_key(row)].append(row)
+
+        for row in right:
+            for match in index.get(right_key(row), ()):
+                yield match + row
+
+    else:
+        index = defaultdict(list)
+        for row in right:
+            index[right_key(row)].append(row)
+
+        for row in left:
+            for match in index.get(left_key(row), ()):
+                yield row + match
+
+def is_sorted(rows, key):
+    """Check that rows are in order of their keys, stopping at the first pair that isn't."""
+    return all(starmap(le, pairwise(map(key, rows))))
+
+def merge_join(left, right, left_keys, right_keys):
+    """
+    Same as hash_join, for when the larger side is already sorted on
+    its keys. The smaller side is sorted, then both sides are walked
+    together: the pointer into the smaller side only moves forward,
+    once per distinct key of the larger side, and the run of matching
+    rows is reused while the larger side repeats that key. The sort is
+    stable, so rows come out in the same order as from hash_join.
+    """
+    left_key, right_key = itemgetter(*left_keys), itemgetter(*right_keys)
+
+    build_first = len(left) <= len(right)
+    if build_first:
+        build, probe, build_key, probe_key = left, right, left_key, right_key
+    else:
+        build, probe, build_key, probe_key = right, left, right_key, left_key
+
+    build = sorted(build, key=build_key)
+    build_keys = list(map(build_key, build))
+    size = len(build)
+    start = 0
+    run_key, run = None, ()
+
+    for row in probe:
+        key = probe_key(row)
+        if key != run_key:
+            while start < size and build_keys[start] < key:
+                start += 1
+
+            end = start
+            while end < size and build_keys[end] == key:
+                end += 1
+
+            run_key, run, start = key, build[start:end], end
+
+        for match in run:
+            yield match + row if build_first else row + match
+
+def use_merge_join(left, right, left_keys, right_keys):
+    """Check whether a join on int keys is large, balanced and sorted enough for merge_join."""
+    smaller, larger = sorted((len(left), len(right)))
+    if smaller + larger < MERGE_JOIN_THRESHOLD or larger > smaller * MERGE_JOIN_MAX_RATIO:
+        return False
+
+    if len(left) <= len(right):
+        return is_sorted(right, itemgetter(*right_keys))
+
+    return is_sorted(left, itemgetter(*left_keys))
+
+def concat_layouts(left, right):
+    """The layout of rows made by appending a row of the right layout to the left."""
+    offset = len(left)
+    layout = dict(left)
+    layout.update((name, offset + index) for name, index in right.items())
+    return layout
+
+def join_relations(relations, equi_joins, tables_by_name):
+    """
+    Hash join the relations (table names, rows, layout) that are
+    connected by equi-join conditions, smallest pair first, until no
+    conditions are left. The relations that remain have to be
+    combined with a cross product.
 
-    return filtered_row
+    Large, balanced joins on int columns where the larger side is
+    already sorted on its keys use merge_join instead.
+    """
+    relations = list(relations)
+    equi_joins = list(equi_joins)
+
+    def owner(expression):
+        table_name = expression['column']['table']
+        return next(i for i, (names, _, _) in enumerate(relations) if table_name in names)
+
+    while equi_joins:
+        pairs = defaultdict(list)
+        for condition in equi_joins:
+            i, j = owner(condition['left']), owner(condition['right'])
+            pairs[min(i, j), max(i, j)].append(condition)
+
+        (i, j), conditions = min(pairs.items(),
+                                 key=lambda p: len(relations[p[0][0]][1]) + len(relations[p[0][1]][1]))
+
+        left_names, left_rows, left_layout = relations[i]
+        right_names, right_rows, right_layout = relations[j]
+
+        left_keys, right_keys = [], []
+        int_keys = True
+        for condition in conditions:
+            sides = [condition['left']['column'], condition['right']['column']]
+            if sides[0]['table'] not in left_names:
+                sides.reverse()
+
+            left_keys.append(left_layout['{}.{}'.format(sides[0]['table'], sides[0]['name'])])
+            right_keys.append(right_layout['{}.{}'.format(sides[1]['table'], sides[1]['name'])])
+            int_keys &= tables_by_name[sides[0]['table']].headers[sides[0]['name']] == 'int'
+            equi_joins.remove(condition)
+
+        join = hash_join
+        if int_keys and use_merge_join(left_rows, right_rows, left_keys, right_keys):
+            join = merge_join
+
+        rows = join(left_rows, right_rows, left_keys, right_keys)
+
+        """
+        Only the last join is left as a generator; anything that is joined
+        or crossed afterwards needs to know its size.
+        """
+        if len(relations) > 2:
+            rows = list(rows)
+
+        relations[i] = (left_names | right_names, rows, concat_layouts(left_layout, right_layout))
+        del relations[j]
+
+    return relations
+
+def select_getter(select_positions):
+    """
+    Build a function that fetches the selected positions from a row
+    in a single call. itemgetter returns a bare value for a single
+    position, so that case is wrapped to keep a tuple.
+    """
+    if len(select_positions) == 1:
+        position = select_positions[0]
+        return lambda row: (row[position],)
+
+    return itemgetter(*select_positions)
+
+def evaluate_select(row, get_selected):
+    """Grab the fields from the select query and properly order the results."""
+    return list(get_selected(row))
+
+def cross_product(row_lists):
+    """Take the product of lists of row tuples, flattening each combination into one tuple."""
+    return (tuple(itertools.chain.from_iterable(row))
+            for row in itertools.product(*row_lists))
+
+"""State shared by every partition handled in a worker process, set up by init_worker."""
+worker_state = {}
+
+def init_worker(inner_rows, residual_clauses, layout, select_positions):
+    worker_state['inner_rows'] = inner_rows
+    worker_state['meets_criteria'] = TableFilter(residual_clauses, layout)
+    worker_state['get_selected'] = select_getter(select_positions)
+
+def join_partition(outer_rows):
+    """Cross a partition of the outer relation with the inner relations, and filter it."""
+    meets_criteria = worker_state['meets_criteria']
+    get_selected = worker_state['get_selected']
+
+    return [
+        evaluate_select(row, get_selected)
+        for row in cross_product([outer_rows] + worker_state['inner_rows'])
+        if meets_criteria(row)
+    ]
+
+def parallel_cross_product(relations, residual_clauses, layout, select_positions):
+    """
+    Split the outer (largest) relation into small partitions of about
+    PARTITION_SIZE combinations, and cross and filter them in worker
+    processes. The inner relations are sent to each worker once.
+
+    Only two partitions per worker are in flight at a time, and a new
+    one is submitted as each result is consumed, so at most that many
+    partition results are held in memory. Partitions are yielded in
+    order, so the results come out in the same order as a serial run.
+    If the consumer stops early, the partitions not yet started are
+    cancelled.
+    """
+    workers = os.cpu_count()
+    outer_rows = relations[0][1]
+    inner_rows = [rows for _, rows, _ in relations[1:]]
+    size = max(1, PARTITION_SIZE // max(1, math.prod(len(rows) for rows in inner_rows)))
+    partitions = (outer_rows[i:i + size] for i in range(0, len(outer_rows), size))
+
+    executor = ProcessPoolExecutor(workers, initializer=init_worker,
+                                   initargs=(inner_rows, residual_clauses, layout, select_positions))
+    try:
+        pending = deque(executor.submit(join_partition, partition)
+                        for partition in itertools.islice(partitions, 2 * workers))
+        while pending:
+            rows = pending.popleft().result()
+            for partition in itertools.islice(partitions, 1):
+                pending.append(executor.submit(join_partition, partition))
+
+            yield from rows
+
+    finally:
+        executor.shutdown(cancel_futures=True)
 
 def execute(query, tables):
     """
@@ -150,22 +495,36 @@ def execute(query, tables):
         * Confirm the where clause is also semantically correct. 
           Split the clausees in to ones that can be evaluated 
           before the join and after the join. 
+        * Push equalities with literals down to every column they
+          transitively apply to.
+        * Load only the columns referenced by the query.
         * Evaluate the clauses on individual tables if it can be 
           done. 
+        * Hash join the tables connected by equality conditions.
         * Take the product of the tables that is left, and then 
           evaluate the leftover where clauses.
     """
+    tables_by_name = {t.name: t for t in tables}
+    col_index = build_column_index(tables)
+
     try:
-        result_headers = validate_and_coalesce_select(query, tables)
+        result_headers = validate_and_coalesce_select(query, tables_by_name, col_index)
     except Exception as e:
         raise Exception("Error in SELECT clause: {}".format(e.args[0]))
 
 
     try:
-        early_clauses, late_clauses = parse_where_clause(query, tables)
+        early_clauses, late_clauses = parse_where_clause(query, tables_by_name, col_index)
     except Exception as e:
         raise Exception("Error in WHERE clause: {}".format(e.args[0]))
 
+    push_down_equalities(query, early_clauses)
+
+    """Only load the columns that the query actually references."""
+    field_names = referenced_columns(query)
+    for table in tables:
+        table.materialize(field_names[table.name])
+
     """
     If there are where clauses that can be evaluated before the join, 
     go ahead and do that now.
@@ -174,25 +533,68 @@ def execute(query, tables):
     for table in tables:
         if table.name in early_clauses:
             early_conditions = early_clauses[table.name]
-            tables_to_join.append(table.filter(early_conditions))
+            rows = table.rows(table.filter(early_conditions))
         else:
-            tables_to_join.append(table)
+            rows = table.rows()
+
+        tables_to_join.append(({table.name}, rows, table.layout()))
+
+    equi_joins, residual_clauses = split_join_clauses(late_clauses)
+    relations = join_relations(tables_to_join, equi_joins, tables_by_name)
 
+    """
+    Put the largest relations first in the product, so the inner
+    relations that are iterated over repeatedly are the small ones.
+    Columns are looked up through the layout, so the order doesn't
+    change the results.
+    """
+    if len(relations) > 1:
+        relations.sort(key=lambda r: len(r[1]), reverse=True)
 
     """
-    Take the product of the tables that are left, and evaluate the
-    leftover clauses now.
+    Take the product of the relations that are left, and evaluate the
+    leftover clauses now. Each joined row is a flat tuple of the
+    relation rows, and the layout maps a qualified column name to its
+    position in that tuple.
     """
     yield result_headers
 
-    meets_criteria = TableFilter(late_clauses)
-    for row in itertools.product(*tables_to_join):
-        joined_row = {}
-        for t in row:
-            joined_row.update(t)
+    layout = {}
+    for _, _, relation_layout in relations:
+        layout = concat_layouts(layout, relation_layout)
 
-        if meets_criteria(joined_row):
-            yield evaluate_select(joined_row, query)
+    """Resolve the selected fields to row positions once, rather than per row."""
+    select_keys = ['{}.{}'.format(f['column']['table'], f['column']['name']) for f in query['select']]
+    select_positions = [layout[k] for k in select_keys]
+    get_selected = select_getter(select_positions)
+
+    """
+    A large cross product that still has clauses to check is split
+    across processes, since evaluating the clauses is what dominates.
+    """
+    if len(relations) > 1 and residual_clauses and (os.cpu_count() or 1) > 1 and \
+            math.prod(len(rows) for _, rows, _ in relations) >= PARALLEL_THRESHOLD:
+        yield from parallel_cross_product(relations, residual_clauses, layout, select_positions)
+        return
+
+    if len(relations) == 1:
+        joined_rows = relations[0][1]
+    else:
+        joined_rows = cross_product([rows for _, rows, _ in relations])
+
+    """
+    With no leftover clauses every joined row is a result, so that
+    case gets its own loop without a filter call per row.
+    """
+    if not residual_clauses:
+        for row in joined_rows:
+            yield evaluate_select(row, get_selected)
+
+    else:
+        meets_criteria = TableFilter(residual_clauses, layout)
+        for row in joined_rows:
+            if meets_criteria(row):
+                yield evaluate_select(row, get_selected)
 
 
 if __name__ == '__main__':
@@ -211,6 +613,17 @@ if __name__ == '__main__':
                             table['as']))
 
 
+    """
+    Stream the result out one row at a time, so it never has to be
+    held in memory as a whole. The headers are pulled first, so a
+    query that fails validation raises before the file is opened.
+    """
     cursor = execute(query, tables)
+    headers = next(cursor)
     with open(args.out_file, 'w+') as f:
-        f.write(json.dumps(list(cursor)))
+        f.write('[')
+        f.write(json.dumps(headers))
+        for row in cursor:
+            f.write(', ')
+            f.write(json.dumps(row))
+        f.write(']')
@@ -1,35 +1,195 @@
 import json
-from table_filter import TableFilter
+import os
+import sys
+from array import array
+from itertools import compress, repeat
+from table_filter import OPERATORS
 
 DATA_TYPES = {
     "int": int,
     "str": str,
 }
 
-class Table(list):
-    """Class that inherits from a list and represents an in memory table.
+"""
+Specialized kernels for comparing an int column with an int literal.
+The comparison is written inline in the comprehension, so the
+interpreter can use its fast path for int comparisons instead of
+calling an operator function for every row.
+"""
+INT_KERNELS = {
+    "=": lambda column, v: [x == v for x in column],
+    "!=": lambda column, v: [x != v for x in column],
+    "<": lambda column, v: [x < v for x in column],
+    "<=": lambda column, v: [x <= v for x in column],
+    ">": lambda column, v: [x > v for x in column],
+    ">=": lambda column, v: [x >= v for x in column],
+}
+
+"""The operator to use when the sides of a condition are swapped."""
+SWAPPED_OPS = {
+    "=": "=",
+    "!=": "!=",
+    "<": ">",
+    "<=": ">=",
+    ">": "<",
+    ">=": "<=",
+}
 
-    * Rows are loaded from a hard coded path to the table.json file
-    * Rows are coalesced to proper data types on import.
-    * Each row is represented by a dictionary so we can easily access keys.
+"""Parsed table files by path, as (mtime, headers, rows, columns, categories)."""
+TABLE_CACHE = {}
+
+def load_table(path):
+    """
+    Parse a table file once, and again only when its modification
+    time changes, in which case the old entry is replaced. Also
+    returns dictionaries of coalesced columns and of the distinct
+    values of str columns by field name. They start empty and are
+    filled in by every Table loaded from the same file.
+    """
+    mtime = os.path.getmtime(path)
+    entry = TABLE_CACHE.get(path)
+
+    if entry is None or entry[0] != mtime:
+        with open(path) as f:
+            headers, *rows = json.load(f)
+
+        entry = TABLE_CACHE[path] = (mtime, headers, rows, {}, {})
+
+    return entry[1:]
+
+class Table:
+    """Class that represents an in memory table, stored by column.
+
+    * Rows are loaded from a hard coded path to the table.json file,
+      which is only parsed once however many times it is aliased.
+    * Columns are only coalesced to proper data types once a query
+      asks for them with materialize(). Int columns are stored as
+      typed arrays, str columns as lists of interned strings.
+    * Columns are keyed by their aliased name, and rows are referred
+      to by their index in the columns.
     """
 
     def __init__(self, table, name):
         self.name = name
         self.table = table
-        table = json.load(open(f'examples/{ table }.table.json'))
+        path = f'examples/{ table }.table.json'
 
-        headers, *rows = table
+        headers, self.raw_rows, self.parsed_columns, self.parsed_categories = load_table(path)
         self.headers = {h[0]: h[1] for h in headers}
+        self.nrows = len(self.raw_rows)
+        self.columns = {}
+
+    def materialize(self, field_names):
+        """Coalesce the given columns out of the raw rows, skipping ones that are already loaded."""
+        for index, field_name in enumerate(self.headers):
+            aliased_name = '.'.join([self.name, field_name])
+            if field_name not in field_names or aliased_name in self.columns:
+                continue
+
+            if field_name not in self.parsed_columns:
+                field_type = self.headers[field_name]
+                values = (DATA_TYPES[field_type](row[index]) for row in self.raw_rows)
+
+                if field_type == 'int':
+                    self.parsed_columns[field_name] = array('q', values)
+                else:
+                    """
+                    Interning makes equal strings the same object, in this
+                    table and any other, so comparing or hashing them for a
+                    join usually stops at an identity check.
+                    """
+                    self.parsed_columns[field_name] = list(map(sys.intern, values))
+
+            self.columns[aliased_name] = self.parsed_columns[field_name]
+
+    def __len__(self):
+        return self.nrows
+
+    def layout(self):
+        """Map each aliased column name to its position in a row tuple."""
+        return {name: index for index, name in enumerate(self.columns)}
+
+    def rows(self, row_ids=None):
+        """Build a tuple for each of the given rows (all rows by default)."""
+        columns = self.columns.values()
+
+        if not columns:
+            return [()] * (self.nrows if row_ids is None else len(row_ids))
 
-        for row in rows:
-            coalesced_row = {}
-            for index, field in enumerate(row):
-                field_name, field_type = headers[index]
-                aliased_name = '.'.join([self.name, field_name])
-                coalesced_row[aliased_name] = DATA_TYPES[field_type](field)
+        if row_ids is None:
+            return list(zip(*columns))
 
-            self.append(coalesced_row) 
+        return list(zip(*([column[row_id] for row_id in row_ids] for column in columns)))
+
+    def operand(self, e):
+        """The column for a column reference, or the literal repeated for every row."""
+        if 'literal' in e:
+            return repeat(e['literal'], self.nrows)
+
+        return self.columns['{}.{}'.format(e['column']['table'], e['column']['name'])]
+
+    def mask(self, condition):
+        """Evaluate a condition for every row, returning one bool per row."""
+        left, op, right = condition['left'], condition['op'], condition['right']
+
+        if 'literal' in left and 'column' in right:
+            left, op, right = right, SWAPPED_OPS[op], left
+
+        if 'column' in left and isinstance(right.get('literal'), int):
+            return INT_KERNELS[op](self.operand(left), right['literal'])
+
+        if 'column' in left and isinstance(right.get('literal'), str):
+            right = {'literal': sys.intern(right['literal'])}
+
+        return list(map(OPERATORS[op], self.operand(left), self.operand(right)))
+
+    def never_matches(self, condition):
+        """
+        Check for an equality between a str column and a literal that
+        isn't one of its values. The distinct values of a column are
+        only collected the first time it is checked, and are shared
+        with every Table loaded from the same file.
+        """
+        if condition['op'] != '=':
+            return False
+
+        for column, literal in ((condition['left'], condition['right']),
+                                (condition['right'], condition['left'])):
+            if 'column' in column and 'literal' in literal:
+                field_name = column['column']['name']
+                if self.headers[field_name] != 'str':
+                    return False
+
+                if field_name not in self.parsed_categories:
+                    self.parsed_categories[field_name] = frozenset(self.parsed_columns[field_name])
+
+                return literal['literal'] not in self.parsed_categories[field_name]
+
+        return False
 
     def filter(self, conditions):
-        return filter(TableFilter(conditions), self)
+        """Return the ids of the rows that meet all of the conditions.
+
+        Each condition is evaluated against whole columns at once,
+        producing a mask with one bool per row, so the loop over the
+        rows runs inside map() or a specialized kernel instead of
+        the generic per-row path.
+
+        With several conditions, each mask is packed into bytes (one
+        0/1 byte per row) and read as a single integer, so all of the
+        masks are combined with a bitwise AND in one pass.
+        """
+        if any(self.never_matches(condition) for condition in conditions):
+            return []
+
+        if not conditions:
+            return list(range(self.nrows))
+
+        if len(conditions) == 1:
+            return list(compress(range(self.nrows), self.mask(conditions[0])))
+
+        bitmap = -1
+        for condition in conditions:
+            bitmap &= int.from_bytes(bytes(self.mask(condition)), 'little')
+
+        return list(compress(range(self.nrows), bitmap.to_bytes(self.nrows, 'little')))
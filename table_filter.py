@@ -1,43 +1,63 @@
-OP_MAPPINGS = {
-    "=": "=="
+import operator
+
+OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+"""
+Range comparisons rule out more rows than != does, so they are
+checked first. Column = column conditions are hash joined before
+the filter runs, so = never reaches TableFilter.
+"""
+OP_RANKS = {
+    "<": 0,
+    "<=": 0,
+    ">": 0,
+    ">=": 0,
+    "!=": 1,
 }
 
 class TableFilter:
     """Class that allows you to create a function given
-    certain filter conditions. 
+    certain filter conditions.
 
     * This class implements __call__ so it can be used as a
-    function once initialized. 
+    function once initialized.
     * It only evaluates one row at a time so it can be pipelined
     with itertools.filter.
+    * Each condition is compiled once into a predicate specialized
+    for its operands, so no parsing happens per row.
+    * Rows are tuples, and the layout maps a qualified column name to
+    its position in the row.
+    * Conditions are the late clauses left over after the hash joins,
+    which always compare columns of two tables with a range operator
+    or !=. Range comparisons are checked before != so that a row
+    fails as early as possible.
     """
-    def __init__(self, conditions):
-        self.conditions = []
-
-        for condition in conditions:
-            self.conditions.append('{left} {op} {right}'.format(
-                left = self.expression(condition['left']),
-                right = self.expression(condition['right']),
-                op = OP_MAPPINGS.get(condition['op'], condition['op'])
-            ))
-
-    def expression(self, e):
-        if 'literal' in e:
-            if isinstance(e['literal'], str):
-                return "'{}'".format(e['literal'])
+    def __init__(self, conditions, layout):
+        self.layout = layout
+        self.preds = []
 
-            return "{}".format(e['literal'])
+        for condition in sorted(conditions, key=lambda c: OP_RANKS[c['op']]):
+            self.preds.append(self.predicate(condition))
 
-        if 'column' in e:
-            return 'row["{}.{}"]'.format(
-                    e['column']['table'],
-                    e['column']['name']
-            )
+    def position(self, e):
+        return self.layout['{}.{}'.format(e['column']['table'], e['column']['name'])]
 
+    def predicate(self, condition):
+        """Build a function of a row that compares the two columns of the condition."""
+        op = OPERATORS[condition['op']]
+        i, j = self.position(condition['left']), self.position(condition['right'])
+        return lambda row: op(row[i], row[j])
 
     def __call__(self, row):
-        for condition in self.conditions:
-            if not eval(condition):
+        for pred in self.preds:
+            if not pred(row):
                 return False
 
         return True